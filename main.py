@@ -1,41 +1,89 @@
 import os
-import requests
+import re
+import hashlib
+import functools
+import threading
+import logging
+import asyncio
+import httpx
+import orjson
+from cachetools import LRUCache, TTLCache
 import gradio as gr
 from dotenv import load_dotenv
 import firebase_admin
 from firebase_admin import credentials, firestore
-from datetime import datetime
+
+logger = logging.getLogger(__name__)
 
 # Load environment variables
 load_dotenv()
 
 FIREBASE_API_KEY = os.getenv("FIREBASE_API_KEY")
 MISTRAL_API_KEY = os.getenv("MISTRAL_API_KEY")
+MISTRAL_CONCURRENCY = int(os.getenv("MISTRAL_CONCURRENCY", 8))
 
 FB_SIGNUP = f"https://identitytoolkit.googleapis.com/v1/accounts:signUp?key={FIREBASE_API_KEY}"
 FB_SIGNIN = f"https://identitytoolkit.googleapis.com/v1/accounts:signInWithPassword?key={FIREBASE_API_KEY}"
+FB_AUTH_PAYLOAD = {"returnSecureToken": True}
+JSON_HEADERS = {"Content-Type": "application/json"}
+
+MISTRAL_URL = "https://api.mistral.ai/v1/chat/completions"
+MISTRAL_MODEL = "mistral-small-latest"
+MISTRAL_HEADERS = {"Authorization": f"Bearer {MISTRAL_API_KEY}", "Content-Type": "application/json"}
+
+# Firebase Admin Setup (initialized once at import, not on the first request)
+# FIREBASE_CRED_SOURCE=env reads the service account JSON from FIREBASE_SERVICE_ACCOUNT,
+# anything else falls back to serviceAccountKey.json on disk
+FIREBASE_CRED_SOURCE = os.getenv("FIREBASE_CRED_SOURCE", "file")
+
+
+def _firebase_credentials():
+    if FIREBASE_CRED_SOURCE == "env":
+        return credentials.Certificate(orjson.loads(os.environ["FIREBASE_SERVICE_ACCOUNT"]))
+    return credentials.Certificate("serviceAccountKey.json")
+
+
+@functools.cache
+def _db():
+    if not firebase_admin._apps:
+        firebase_admin.initialize_app(_firebase_credentials())
+    return firestore.client()
+
 
-# Firebase Admin Setup
-cred = credentials.Certificate("serviceAccountKey.json")
-firebase_admin.initialize_app(cred)
-db = firestore.client()
+db = _db()
+
+
+# ------------------ SHARED HTTP CLIENT ------------------ #
+# One long-lived client so keep-alive / HTTP/2 connections are reused across handlers.
+# It lives as long as the process; its pooled connections belong to the server's
+# event loop, so there is no separate close step at exit.
+HTTP = httpx.AsyncClient(
+    http2=True,
+    limits=httpx.Limits(max_connections=100, max_keepalive_connections=20),
+    # Fail fast on connect, allow slow reads for long generations
+    timeout=httpx.Timeout(30.0, connect=3.0),
+    headers={"User-Agent": "mindease/1.0"}
+)
+
+# Caps in-flight Mistral requests so bursts of users queue instead of hitting 429s
+MISTRAL_SEM = asyncio.Semaphore(MISTRAL_CONCURRENCY)
 
 
 # ------------------ SAFE SIGNUP ------------------ #
-def signup(email, password):
-    data = {"email": email, "password": password, "returnSecureToken": True}
+async def signup(email, password):
+    data = {**FB_AUTH_PAYLOAD, "email": email, "password": password}
     try:
-        res = requests.post(FB_SIGNUP, json=data)
-        data = res.json()
+        res = await HTTP.post(FB_SIGNUP, content=orjson.dumps(data), headers=JSON_HEADERS)
+        data = orjson.loads(res.content)
 
         if res.status_code != 200:
             error_msg = data.get("error", {}).get("message", "Unknown error")
             return f"❌ Signup Error: {error_msg}"
 
-        # Save to Firestore
-        db.collection("users").document(data["localId"]).set({
+        # Save to Firestore (blocking SDK, so off the event loop)
+        await asyncio.to_thread(db.collection("users").document(data["localId"]).set, {
             "email": email,
-            "created_at": datetime.utcnow(),
+            "created_at": firestore.SERVER_TIMESTAMP,
             "last_login": None
         })
 
@@ -46,12 +94,12 @@ def signup(email, password):
 
 
 # ------------------ SAFE LOGIN ------------------ #
-def login(email, password, session):
-    data = {"email": email, "password": password, "returnSecureToken": True}
+async def login(email, password, session):
+    data = {**FB_AUTH_PAYLOAD, "email": email, "password": password}
 
     try:
-        res = requests.post(FB_SIGNIN, json=data)
-        data = res.json()
+        res = await HTTP.post(FB_SIGNIN, content=orjson.dumps(data), headers=JSON_HEADERS)
+        data = orjson.loads(res.content)
 
         if res.status_code != 200:
             return "❌ Invalid email or password.", session
@@ -60,8 +108,8 @@ def login(email, password, session):
         session["uid"] = data["localId"]
         session["email"] = data["email"]
 
-        db.collection("users").document(data["localId"]).update({
-            "last_login": datetime.utcnow()
+        await asyncio.to_thread(db.collection("users").document(data["localId"]).update, {
+            "last_login": firestore.SERVER_TIMESTAMP
         })
 
         return "✅ Login successful!", session
@@ -75,62 +123,219 @@ def save_message(uid, role, text):
     db.collection("chats").document(uid).collection("messages").add({
         "role": role,
         "text": text,
-        "time": datetime.utcnow()
+        "time": firestore.SERVER_TIMESTAMP
     })
+    invalidate_history(uid)
+
+
+async def async_save(uid, role, text):
+    # Firestore client is blocking, so run the write in the default thread pool
+    await asyncio.to_thread(save_message, uid, role, text)
+
+
+async def async_save_after(first, uid, role, text):
+    # Wait (without re-raising) so a reply is never stamped before its prompt
+    await asyncio.wait({first})
+    await async_save(uid, role, text)
+
+
+# Strong refs to in-flight background writes so they aren't garbage collected
+_pending_writes = set()
+
+
+def _background_done(task):
+    _pending_writes.discard(task)
+    # Retrieving the exception here also stops "Task exception was never retrieved"
+    if not task.cancelled() and task.exception() is not None:
+        logger.error("Background write failed", exc_info=task.exception())
+
+
+def run_in_background(coro):
+    task = asyncio.ensure_future(coro)
+    _pending_writes.add(task)
+    task.add_done_callback(_background_done)
+    return task
 
 
 # ------------------ LOAD CHAT HISTORY ------------------ #
+# Rendered history per uid, reused until it expires or a new message is saved.
+# Both caches are bounded so idle users are evicted instead of accumulating.
+HISTORY_TTL = 30
+HISTORY_USERS = 1024
+HISTORY_CACHE = TTLCache(maxsize=HISTORY_USERS, ttl=HISTORY_TTL)
+
+# Rendered lines and the oldest/newest loaded snapshots per uid, so refreshes only
+# fetch new messages and "Load older" only fetches the page before the window
+HISTORY_PAGE = 200
+HISTORY_STATE = LRUCache(maxsize=HISTORY_USERS)
+
+# cachetools caches aren't thread-safe and sync handlers run in Gradio's thread pool
+_history_lock = threading.Lock()
+
+
+def _messages(uid):
+    return db.collection("chats").document(uid).collection("messages")
+
+
+def _render_message(msg):
+    return f"**[{msg['role']}]** ({msg['time']:%Y-%m-%d %H:%M:%S}) → {msg['text']}\n\n"
+
+
+def _newest_first(col, limit, before=None):
+    # Snapshot cursors add a __name__ tie-breaker, so messages sharing a timestamp
+    # at a page edge aren't skipped the way a bare time value would skip them
+    query = col.order_by("time", direction=firestore.Query.DESCENDING)
+    if before is not None:
+        query = query.start_after(before)
+    return query.limit(limit).get()
+
+
+def _history_state(uid):
+    with _history_lock:
+        state = HISTORY_STATE.get(uid)
+        if state is None:
+            state = {"lines": [], "first": None, "last": None, "gen": 0, "lock": threading.Lock()}
+            HISTORY_STATE[uid] = state
+        return state
+
+
+def _cache_history(uid, state, gen):
+    history_text = "".join(["### 🕒 Chat History\n\n", *state["lines"]])
+    with _history_lock:
+        # A write (or eviction) during the read may have been missed, so only cache
+        # the text if nothing changed since the read started
+        if HISTORY_STATE.get(uid) is state and state["gen"] == gen:
+            HISTORY_CACHE[uid] = history_text
+    return history_text
+
+
+def invalidate_history(uid):
+    with _history_lock:
+        HISTORY_CACHE.pop(uid, None)
+        state = HISTORY_STATE.get(uid)
+        if state is not None:
+            state["gen"] += 1
+
+
 def load_history(session):
     if not session.get("logged_in"):
         return "❌ Please login to view history."
 
     uid = session["uid"]
-    docs = db.collection("chats").document(uid).collection("messages").order_by("time").stream()
+    with _history_lock:
+        cached = HISTORY_CACHE.get(uid)
+    if cached is not None:
+        return cached
 
-    history_text = "### 🕒 Chat History\n\n"
-    for d in docs:
-        msg = d.to_dict()
-        t = msg["time"].strftime("%Y-%m-%d %H:%M:%S")
-        history_text += f"**[{msg['role']}]** ({t}) → {msg['text']}\n\n"
+    state = _history_state(uid)
+    # One refresh per uid at a time so concurrent tabs don't append the same delta twice
+    with state["lock"]:
+        gen = state["gen"]
+        col = _messages(uid)
+
+        if state["last"] is not None:
+            docs = list(col.order_by("time").start_after(state["last"]).stream())
+        else:
+            # First load: only the most recent page, newest first, flipped for display
+            docs = _newest_first(col, HISTORY_PAGE)[::-1]
+
+        state["lines"].extend(_render_message(d.to_dict()) for d in docs)
+
+        if docs:
+            if state["first"] is None:
+                state["first"] = docs[0]
+            state["last"] = docs[-1]
+
+        return _cache_history(uid, state, gen)
+
+
+def load_older_history(session):
+    if not session.get("logged_in"):
+        return "❌ Please login to view history."
+
+    uid = session["uid"]
+    state = _history_state(uid)
+    if state["first"] is None:
+        return load_history(session)
+
+    with state["lock"]:
+        gen = state["gen"]
+        docs = _newest_first(_messages(uid), HISTORY_PAGE, before=state["first"])[::-1]
+        if docs:
+            state["first"] = docs[0]
+            state["lines"][:0] = [_render_message(d.to_dict()) for d in docs]
+
+        return _cache_history(uid, state, gen)
+
+
+# ------------------ MISTRAL AI CHAT (STREAMING) ------------------ #
+# Replies to short, common prompts ("hi", "I feel anxious") are reused across users
+REPLY_CACHE = LRUCache(maxsize=4096)
+REPLY_CACHE_MAX_LEN = 200
 
-    return history_text
 
+def _reply_key(message):
+    return hashlib.blake2b(f"{MISTRAL_MODEL}\0{message}".encode(), digest_size=16).digest()
 
-# ------------------ MISTRAL AI CHAT (NO ERRORS) ------------------ #
-def mistral_chat(message, history, session):
+
+async def mistral_chat(message, history, session):
     if history is None:
         history = []
 
     if not session.get("logged_in"):
         history.append(("System", "❌ Please login to chat."))
-        return history, history
-
-    try:
-        response = requests.post(
-            "https://api.mistral.ai/v1/chat/completions",
-            headers={"Authorization": f"Bearer {MISTRAL_API_KEY}"},
-            json={
-                "model": "mistral-small-latest",
-                "messages": [{"role": "user", "content": message}]
-            }
-        )
-
-        data = response.json()
+        yield history, history
+        return
 
-        bot_reply = data["choices"][0]["message"]["content"]
+    # The user message doesn't depend on the reply, so write it while Mistral thinks
+    user_write = run_in_background(async_save(session["uid"], "user", message))
 
-        # Append correctly
-        history.append((message, bot_reply))
+    bot_reply = ""
+    history.append((message, bot_reply))
+    # Show the user's message straight away, before any tokens arrive
+    yield history, history
 
-        # Save chat messages
-        save_message(session["uid"], "user", message)
-        save_message(session["uid"], "bot", bot_reply)
+    cache_key = _reply_key(message) if len(message) < REPLY_CACHE_MAX_LEN else None
 
-        return history, history
+    try:
+        if cache_key is not None and cache_key in REPLY_CACHE:
+            bot_reply = REPLY_CACHE[cache_key]
+            history[-1] = (message, bot_reply)
+            yield history, history
+        else:
+            async with MISTRAL_SEM:
+                # Stream tokens into the chatbot as they arrive
+                payload = {
+                    "model": MISTRAL_MODEL,
+                    "messages": [{"role": "user", "content": message}],
+                    "stream": True
+                }
+                async with HTTP.stream("POST", MISTRAL_URL, headers=MISTRAL_HEADERS, content=orjson.dumps(payload)) as response:
+                    response.raise_for_status()
+
+                    async for line in response.aiter_lines():
+                        if not line.startswith("data: ") or line == "data: [DONE]":
+                            continue
+
+                        delta = orjson.loads(line[6:])["choices"][0]["delta"].get("content") or ""
+                        if delta:
+                            bot_reply += delta
+                            history[-1] = (message, bot_reply)
+                            yield history, history
+
+            if cache_key is not None and bot_reply:
+                REPLY_CACHE[cache_key] = bot_reply
+
+        # Save the bot reply without holding up the response
+        run_in_background(async_save_after(user_write, session["uid"], "bot", bot_reply))
 
     except Exception as e:
+        # user_write keeps running so the prompt stays in history; a failed write is
+        # logged by its done-callback
+        if not bot_reply:
+            history.pop()
         history.append(("Error", f"❌ Chat Error: {str(e)}"))
-        return history, history
+        yield history, history
 
 
 # ------------------ LOGOUT ------------------ #
@@ -144,7 +349,6 @@ def logout(session):
 
 # ------------------ CUSTOM UI CSS ------------------ #
 CUSTOM_CSS = """
-<style>
 body { background: #0F172A; font-family: 'Inter', sans-serif;}
 .gradio-container { max-width: 900px !important; margin: auto; }
 
@@ -170,65 +374,87 @@ button {
     border-radius: 10px !important;
     font-weight: bold !important;
 }
-</style>
 """
+# Gradio takes raw CSS; collapse whitespace once at import to keep the page payload small
+CUSTOM_CSS = re.sub(r"\s+", " ", CUSTOM_CSS).strip()
 
 
 # ------------------ APP UI ------------------ #
-with gr.Blocks(css=CUSTOM_CSS, theme=gr.themes.Soft()) as app:
-
-    session = gr.State({"logged_in": False, "uid": None, "email": None})
-    chat_history = gr.State([])
-
-    gr.Markdown("## 💬 Modern AI Chat App with Firebase Auth + Firestore")
-
-    # Signup Tab
-    with gr.Tab("Signup"):
-        with gr.Box(elem_classes="card"):
-            s_email = gr.Textbox(label="Email")
-            s_pass = gr.Textbox(label="Password", type="password")
-            s_btn = gr.Button("Create Account")
-            s_msg = gr.Markdown()
-            s_btn.click(signup, inputs=[s_email, s_pass], outputs=s_msg)
-
-    # Login Tab
-    with gr.Tab("Login"):
-        with gr.Box(elem_classes="card"):
-            l_email = gr.Textbox(label="Email")
-            l_pass = gr.Textbox(label="Password", type="password")
-            l_btn = gr.Button("Login")
-            l_msg = gr.Markdown()
-            l_btn.click(login, inputs=[l_email, l_pass, session], outputs=[l_msg, session])
-
-    # Chat Tab
-    with gr.Tab("Chat"):
-        with gr.Box(elem_classes="card"):
-            chatbot = gr.Chatbot()
-            msg = gr.Textbox(label="Message")
-            send = gr.Button("Send")
-            logout_btn = gr.Button("Logout")
-            logout_msg = gr.Markdown()
-
-            send.click(mistral_chat,
-                       inputs=[msg, chat_history, session],
-                       outputs=[chatbot, chat_history])
-
-            logout_btn.click(logout,
-                             inputs=[session],
-                             outputs=[logout_msg, session, chatbot, chat_history])
-
-    # History Viewer
-    with gr.Tab("Chat History Viewer"):
-        with gr.Box(elem_classes="card"):
-            history_btn = gr.Button("🔄 Load Chat History")
-            history_display = gr.Markdown()
-
-            history_btn.click(load_history,
-                              inputs=[session],
-                              outputs=[history_display])
-
-
-port = int(os.environ.get("PORT", 10000))
-app.launch(server_name="0.0.0.0", server_port=port)
-
+def create_app():
+    with gr.Blocks(css=CUSTOM_CSS, theme=gr.themes.Soft()) as app:
+
+        session = gr.State({"logged_in": False, "uid": None, "email": None})
+        chat_history = gr.State([])
+
+        gr.Markdown("## 💬 Modern AI Chat App with Firebase Auth + Firestore")
+
+        # Signup Tab
+        with gr.Tab("Signup"):
+            with gr.Box(elem_classes="card"):
+                s_email = gr.Textbox(label="Email")
+                s_pass = gr.Textbox(label="Password", type="password")
+                s_btn = gr.Button("Create Account")
+                s_msg = gr.Markdown()
+                s_btn.click(signup, inputs=[s_email, s_pass], outputs=s_msg, concurrency_limit=None)
+
+        # Login Tab
+        with gr.Tab("Login"):
+            with gr.Box(elem_classes="card"):
+                l_email = gr.Textbox(label="Email")
+                l_pass = gr.Textbox(label="Password", type="password")
+                l_btn = gr.Button("Login")
+                l_msg = gr.Markdown()
+                l_btn.click(login, inputs=[l_email, l_pass, session], outputs=[l_msg, session],
+                            concurrency_limit=None)
+
+        # Chat Tab
+        with gr.Tab("Chat"):
+            with gr.Box(elem_classes="card"):
+                chatbot = gr.Chatbot()
+                msg = gr.Textbox(label="Message")
+                send = gr.Button("Send")
+                logout_btn = gr.Button("Logout")
+                logout_msg = gr.Markdown()
+
+                # Gradio defaults each listener to one run at a time; lift that so
+                # concurrent chatters are limited only by MISTRAL_SEM
+                send.click(mistral_chat,
+                           inputs=[msg, chat_history, session],
+                           outputs=[chatbot, chat_history],
+                           concurrency_limit=None)
+
+                logout_btn.click(logout,
+                                 inputs=[session],
+                                 outputs=[logout_msg, session, chatbot, chat_history])
+
+        # History Viewer
+        with gr.Tab("Chat History Viewer"):
+            with gr.Box(elem_classes="card"):
+                history_btn = gr.Button("🔄 Load Chat History")
+                older_btn = gr.Button("⏪ Load Older")
+                history_display = gr.Markdown()
+
+                history_btn.click(load_history,
+                                  inputs=[session],
+                                  outputs=[history_display])
+
+                older_btn.click(load_older_history,
+                                inputs=[session],
+                                outputs=[history_display])
+
+    return app
+
+
+app = create_app()
+
+
+if __name__ == "__main__":
+    # Prefer uvloop's faster event loop when it's available
+    try:
+        import uvloop
+        uvloop.install()
+    except ImportError:
+        pass
 
+    port = int(os.environ.get("PORT", 10000))
+    app.launch(server_name="0.0.0.0", server_port=port)